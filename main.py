@@ -1,42 +1,58 @@
 # main.py
 import os
 import re
-import html
+import atexit
+import queue
 import asyncio
+import functools
 import logging
 import time
 from collections import deque
-from threading import Thread
-from flask import Flask
-from telethon import TelegramClient, events, types
-from dotenv import load_dotenv
-
-# Load .env in dev; Railway provides env vars via the dashboard
-load_dotenv()
+from logging.handlers import QueueHandler, QueueListener
+from aiohttp import web
+from aiolimiter import AsyncLimiter
+from telethon import TelegramClient, events
+from telethon.errors import ChatWriteForbiddenError, FloodWaitError
+
+def _load_env():
+    # Load .env in dev; Railway provides env vars via the dashboard and has no
+    # .env file, so python-dotenv is not even imported there
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+    if os.path.exists(path):
+        from dotenv import load_dotenv
+        load_dotenv(path)
+
+_load_env()
 
 # ----------------------
 # Logging
 # ----------------------
+# Records are formatted on the caller and written by a listener thread, so
+# the event loop never blocks on console/file I/O
+log_queue = queue.Queue()
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(), logging.FileHandler('bot.log')]
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener = QueueListener(log_queue, logging.StreamHandler(), logging.FileHandler('bot.log'))
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # ----------------------
-# Flask keep-alive (Railway Web Process)
+# Keep-alive web server (Railway Web Process)
 # ----------------------
-app = Flask(__name__)
-
-@app.route('/')
-def index():
-    return "Bot is running!"
-
-def run_web(port):
-    app.run(host='0.0.0.0', port=port)
-
-def keep_alive(port):
-    Thread(target=run_web, args=(port,), daemon=True).start()
+async def index(request):
+    return web.Response(text="Bot is running!")
+
+async def start_web(port):
+    # Served from the bot's own event loop, no extra thread
+    app = web.Application()
+    app.router.add_get('/', index)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    return runner
 
 # ----------------------
 # Env loader + helpers
@@ -56,33 +72,88 @@ BOT_TOKEN = get_env("BOT_TOKEN", required=True)
 def parse_channel_list(s):
     if not s:
         return []
-    parts = [p.strip() for p in s.split(",") if p.strip()]
     out = []
-    for p in parts:
-        try:
-            out.append(int(p))
-        except:
-            out.append(p)
+    for p in s.split(","):
+        p = p.strip()
+        if not p:
+            continue
+        # Numeric IDs (including negative channel IDs) become ints, the rest stay usernames
+        digits = p[1:] if p.startswith("-") else p
+        out.append(int(p) if digits.isdecimal() else p)
     return out
 
 SOURCE_CHANNELS = parse_channel_list(get_env("SOURCE_CHANNELS", required=True))
 TARGET_CHANNELS = parse_channel_list(get_env("TARGET_CHANNELS", required=True))
 
 QUEUE_DELAY = get_env("QUEUE_DELAY", default="120", cast=int)
-RATE_LIMIT = get_env("RATE_LIMIT", default="60", cast=int)
+POST_BURST = get_env("POST_BURST", default="3", cast=int)
+SEND_CONCURRENCY = get_env("SEND_CONCURRENCY", default="5", cast=int)
+MAX_FLOOD_WAIT = get_env("MAX_FLOOD_WAIT", default="300", cast=int)
+if os.environ.get("RATE_LIMIT"):
+    logging.warning("RATE_LIMIT is no longer used and is ignored; posts are paced "
+                    "by QUEUE_DELAY and POST_BURST")
 PORT = get_env("PORT", default="8080", cast=int)
 
 # ----------------------
 # Telethon client + queue
 # ----------------------
-client = TelegramClient('bot_session', API_ID, API_HASH)
-message_queue = deque()
-is_forwarding = False
-last_forward_time = 0
+# Telethon reconnects on its own; retry forever, 5s apart
+client = TelegramClient(
+    'bot_session', API_ID, API_HASH,
+    connection_retries=-1,
+    retry_delay=5,
+    auto_reconnect=True,
+    request_retries=5
+)
+target_peers = []
+message_queue = asyncio.Queue()
+# Recently queued posts; sources often re-post the same code seconds apart
+recent_posts = deque(maxlen=200)
+# Telegram's global bot limit is ~30 messages/s
+send_limiter = AsyncLimiter(30, 1)
+send_slots = asyncio.Semaphore(SEND_CONCURRENCY)
+SEND_RETRIES = 3
+# Targets we are not allowed to post in; skipped until restart
+dead_targets = set()
 
 # ----------------------
 # Helper functions
 # ----------------------
+# Pattern compiled once at import; the handler runs it on every event
+_RE_MSG1 = re.compile(r'(?:🎁|👥)\s*(?P<code>[A-Z0-9]+)')
+# Zero-width characters are a fixed set, so str.translate() beats a regex
+_ZWSP_TABLE = dict.fromkeys((0x200b, 0x200c, 0x200d, 0xFEFF), None)
+
+# Outgoing message, built once: clickable 🧧 link + code + footer
+_TEMPLATE = (
+    '<a href="https://t.me/BinanceRedPacket_Hub">🧧</a> <code>%s</code>\n\n'
+    "﹍﹍﹍﹍﹍﹍﹍﹍﹍﹍﹍﹍\n➠ @TheBinance_Hub \n➠ @BTCxBTCxBTC"
+)
+
+def strip_html_tags(text):
+    # Telegram usually sends markup as entities, so most text has no '<'
+    if '<' not in text:
+        return text
+    # Same result as re.sub(r'<[^>]+>', '', text), without the regex engine
+    out = []
+    start = pos = 0
+    while True:
+        j = text.find('<', pos)
+        if j < 0:
+            break
+        k = text.find('>', j + 1)
+        if k < 0:
+            break
+        if k == j + 1:
+            # '<>' is not a tag
+            pos = k
+            continue
+        out.append(text[start:j])
+        start = pos = k + 1
+    out.append(text[start:])
+    return ''.join(out)
+
+@functools.lru_cache(maxsize=512)
 def parse_and_format_message(text):
     """
     Extract only valid messages:
@@ -92,50 +163,47 @@ def parse_and_format_message(text):
     Replace emoji with clickable 🧧 link.
     """
 
-    if not text:
+    # Both markers are non-ASCII, so pure-ASCII text can never match
+    if not text or text.isascii():
         return None
 
-    # Split lines, remove empty ones
-    lines = [line.strip() for line in text.split("\n") if line.strip()]
-    if not lines:
+    # Most messages carry no marker at all; reject them before any copying
+    if '🎁' not in text and '👥' not in text:
         return None
 
-    # Only check first real line
-    first_line = lines[0]
-
-    # Remove zero-width characters and HTML tags
-    cleaned = re.sub(r'[\u200b\u200c\u200d\uFEFF]', '', first_line)
-    cleaned = re.sub(r'<[^>]+>', '', cleaned).strip()
-
-    # Match 🎁 or 👥 + CODE
-    m = re.match(r'^(🎁|👥)\s*([A-Z0-9]+)$', cleaned)
-    if not m:
+    # Only check first real line: lstrip() skips leading blank lines, then
+    # only the text up to the first newline is sliced out
+    s = text.lstrip()
+    nl = s.find("\n")
+    first_line = (s if nl < 0 else s[:nl]).strip()
+    if not first_line:
         return None
 
-    code = m.group(2)
+    # The marker may be further down; skip the regex work unless it is on this line
+    if '🎁' not in first_line and '👥' not in first_line:
+        return None
 
-    # New emoji
-    emoji = "🧧"
+    # Match 🎁 or 👥 + CODE. A line that already matches holds no tags or
+    # zero-width characters, so cleaning is only done when the plain match fails
+    m = _RE_MSG1.fullmatch(first_line)
+    if not m:
+        # Remove zero-width characters and HTML tags
+        cleaned = strip_html_tags(first_line.translate(_ZWSP_TABLE)).strip()
+        m = _RE_MSG1.fullmatch(cleaned)
+        if not m:
+            return None
 
-    # Clickable link
-    link = f'<a href="https://t.me/BinanceRedPacket_Hub">{emoji}</a>'
+    # [A-Z0-9]+ cannot contain any of &<>"' so the code needs no HTML escaping
+    code = m['code']
 
     # Final formatted output
-    formatted = (
-        f"{link} <code>{html.escape(code)}</code>\n\n"
-        f"﹍﹍﹍﹍﹍﹍﹍﹍﹍﹍﹍﹍\n➠ @TheBinance_Hub \n➠ @BTCxBTCxBTC"
-    )
-
-    return formatted
+    return _TEMPLATE % code
 
 
 # ----------------------
 # Handle incoming messages
 # ----------------------
-@client.on(events.NewMessage(chats=SOURCE_CHANNELS))
 async def new_message_handler(event):
-    global is_forwarding, last_forward_time
-
     try:
         raw_text = event.message.message or ""
 
@@ -143,15 +211,14 @@ async def new_message_handler(event):
         if not parsed:
             return
 
-        now = time.time()
-        if (not is_forwarding) or (now - last_forward_time > RATE_LIMIT):
-            await forward_to_targets(parsed)
-            last_forward_time = now
-            is_forwarding = True
-            client.loop.create_task(process_queue())
-        else:
-            message_queue.append(parsed)
-            logging.info(f"Queued message (size={len(message_queue)})")
+        # The post is fully determined by the code, so this dedups by code
+        if parsed in recent_posts:
+            logging.info("Skipped duplicate code")
+            return
+        recent_posts.append(parsed)
+
+        message_queue.put_nowait(parsed)
+        logging.info(f"Queued message (size={message_queue.qsize()})")
 
     except Exception:
         logging.exception("Error in handler:")
@@ -159,50 +226,124 @@ async def new_message_handler(event):
 # ----------------------
 # Forward messages
 # ----------------------
-async def forward_to_targets(html_message):
-    for ch in TARGET_CHANNELS:
+async def send_one(ch, peer, html_message):
+    # Returns True once the post is delivered to this target
+    backoff = 1
+    for attempt in range(1, SEND_RETRIES + 1):
+        last = attempt == SEND_RETRIES
         try:
-            await client.send_message(
-                entity=ch,
-                message=html_message,
-                parse_mode='html',
-                link_preview=False
-            )
-            await asyncio.sleep(1)
+            async with send_slots, send_limiter:
+                await client.send_message(
+                    entity=peer,
+                    message=html_message,
+                    parse_mode='html',
+                    link_preview=False
+                )
+            return True
+        except FloodWaitError as e:
+            # Waits under Telethon's flood_sleep_threshold are slept internally;
+            # longer ones land here. The single queue worker awaits this send,
+            # so waits beyond MAX_FLOOD_WAIT drop the post for this target
+            # instead of holding up every queued post
+            if last or e.seconds > MAX_FLOOD_WAIT:
+                logging.error(f"Flood wait of {e.seconds}s for {ch}; dropping this post there")
+                return False
+            logging.warning(f"Flood wait of {e.seconds}s for {ch}; retrying")
+            await asyncio.sleep(e.seconds + 0.1)
+        except ChatWriteForbiddenError:
+            logging.error(f"No permission to post in {ch}; skipping it from now on")
+            dead_targets.add(ch)
+            return False
+        except ConnectionError:
+            if last:
+                logging.error(f"Giving up on {ch} after {SEND_RETRIES} attempts")
+                return False
+            logging.warning(f"Network error sending to {ch}; retrying in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff *= 2
         except Exception:
             logging.exception(f"Failed to send to {ch}")
-            await asyncio.sleep(2)
+            return False
+
+async def forward_to_targets(html_message):
+    # Per-chat limits are independent, so targets are sent concurrently;
+    # pacing is left to send_limiter
+    results = await asyncio.gather(
+        *[
+            send_one(ch, peer, html_message)
+            for ch, peer in zip(TARGET_CHANNELS, target_peers)
+            if ch not in dead_targets
+        ],
+        return_exceptions=True
+    )
+    # Delivered nowhere: forget it so a re-post of the same code is not
+    # skipped as a duplicate
+    if results and not any(r is True for r in results) and html_message in recent_posts:
+        recent_posts.remove(html_message)
 
 async def process_queue():
-    global is_forwarding
-    while message_queue:
-        await asyncio.sleep(QUEUE_DELAY)
-        msg = message_queue.popleft()
+    # Single long-lived worker started by run_bot. Posts are paced by a token
+    # bucket holding up to POST_BURST tokens, refilled one per QUEUE_DELAY
+    # seconds; after QUEUE_DELAY * POST_BURST seconds idle it is full again
+    burst = max(POST_BURST, 1)
+    tokens = float(burst)
+    last_refill = time.monotonic()
+    while True:
+        msg = await message_queue.get()
+        if QUEUE_DELAY > 0:
+            now = time.monotonic()
+            tokens = min(burst, tokens + (now - last_refill) / QUEUE_DELAY)
+            last_refill = now
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) * QUEUE_DELAY)
+                tokens = 1.0
+                last_refill = time.monotonic()
+            tokens -= 1
         await forward_to_targets(msg)
-    is_forwarding = False
-
-# ----------------------
-# Reconnection handler
-# ----------------------
-@client.on(events.Raw)
-async def handle_raw(event):
-    if isinstance(event, types.UpdateConnectionState):
-        if event.state == types.ConnectionState.disconnected:
-            logging.warning("Disconnected. Reconnecting...")
-            await asyncio.sleep(5)
-            try:
-                await client.connect()
-            except:
-                logging.exception("Reconnect failed")
+        message_queue.task_done()
 
 # ----------------------
 # Start bot
 # ----------------------
+async def resolve_peers(channels):
+    # Resolve once at startup so sends skip the per-call entity lookup;
+    # anything unresolvable is kept as-is and retried by Telethon per send
+    peers = []
+    for ch in channels:
+        try:
+            peers.append(await client.get_input_entity(ch))
+        except Exception:
+            logging.exception(f"Failed to resolve {ch}")
+            peers.append(ch)
+    return peers
+
+def log_worker_exit(task):
+    # process_queue should run forever; surface it if it ever dies
+    if not task.cancelled() and task.exception():
+        logging.error("Queue worker stopped", exc_info=task.exception())
+
 async def run_bot():
+    global target_peers
+    runner = await start_web(PORT)
     await client.start(bot_token=BOT_TOKEN)
+    target_peers = await resolve_peers(TARGET_CHANNELS)
+    source_peers = await resolve_peers(SOURCE_CHANNELS)
+    client.add_event_handler(new_message_handler, events.NewMessage(chats=source_peers))
     logging.info("Bot started.")
-    await client.run_until_disconnected()
+    worker = asyncio.create_task(process_queue())
+    worker.add_done_callback(log_worker_exit)
+    try:
+        await client.run_until_disconnected()
+    finally:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        await runner.cleanup()
 
 if __name__ == "__main__":
-    keep_alive(PORT)
+    # uvloop is optional (not available on Windows); fall back to asyncio's loop
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     asyncio.run(run_bot())